@@ -3,8 +3,8 @@ import logging
 import sys
 
 # Check that we're not running on an unsupported Python version.
-if sys.version_info < (3, 5):
-    print("jose_bot requires Python 3.5 or above.")
+if sys.version_info < (3, 7):
+    print("jose_bot requires Python 3.7 or above.")
     sys.exit(1)
 
 logger = logging.getLogger(__name__)
@@ -15,7 +15,7 @@ def run():
         from jose_bot import main
 
         # Run the main function of the bot
-        asyncio.get_event_loop().run_until_complete(main.main())
+        asyncio.run(main.main())
     except ImportError as e:
         print("Unable to import jose_bot.main:", e)
     except KeyboardInterrupt:
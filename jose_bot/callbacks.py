@@ -1,4 +1,6 @@
+import asyncio
 import logging
+from typing import Any, Awaitable, Dict, Optional, Tuple
 
 from nio import (
     AsyncClient,
@@ -6,20 +8,24 @@ from nio import (
     JoinError,
     MatrixRoom,
     PowerLevels,
+    PowerLevelsEvent,
     RoomGetEventError,
     RoomGetStateEventError,
+    RoomInfo,
     RoomMemberEvent,
     RoomPutStateError,
+    SyncResponse,
     UnknownEvent,
 )
 
 from jose_bot.chat_functions import send_text_to_room
 from jose_bot.config import Config
 from jose_bot.utils import (
+    BOT_NAMESPACE,
+    EMPTY,
     get_bot_event_type,
     get_user_id_parts,
     hash_user_id,
-    is_bot_event,
     user_name,
 )
 
@@ -27,6 +33,8 @@ logger = logging.getLogger(__name__)
 
 
 class Callbacks:
+    __slots__ = ("client", "config", "_pl_cache", "_pl_locks")
+
     def __init__(self, client: AsyncClient, config: Config):
         """
         Args:
@@ -38,6 +46,87 @@ class Callbacks:
         """
         self.client = client
         self.config = config
+        # Latest m.room.power_levels content seen for each room
+        self._pl_cache: Dict[str, Dict[str, Any]] = {}
+        # Serializes read-modify-write updates of a room's power levels
+        self._pl_locks: Dict[str, asyncio.Lock] = {}
+
+    def _power_levels_lock(self, room_id: str) -> asyncio.Lock:
+        """Get the lock guarding power level updates in a room.
+
+        Args:
+            room_id: The ID of the room.
+        """
+        lock = self._pl_locks.get(room_id)
+        if lock is None:
+            lock = self._pl_locks[room_id] = asyncio.Lock()
+        return lock
+
+    async def _get_power_levels(self, room: MatrixRoom) -> Optional[Dict[str, Any]]:
+        """Get the m.room.power_levels content of a room, from the cache if possible.
+
+        Args:
+            room: The room to get the power levels of.
+
+        Returns:
+            The power levels content, or None if it couldn't be fetched.
+        """
+        content = self._pl_cache.get(room.room_id)
+        if content is not None:
+            return content
+        state_resp = await self.client.room_get_state_event(
+            room.room_id, "m.room.power_levels"
+        )
+        if isinstance(state_resp, RoomGetStateEventError):
+            logger.warn(
+                "Failed to get power level data in room %s (%s). Stop processing.",
+                room.display_name,
+                room.room_id,
+            )
+            return None
+        content = state_resp.content
+        self._pl_cache[room.room_id] = content
+        return content
+
+    def clear_power_levels_cache(self) -> None:
+        """Forget the cached power levels of all rooms, they are fetched again when
+        needed.
+        """
+        self._pl_cache.clear()
+
+    async def power_levels(self, room: MatrixRoom, event: PowerLevelsEvent) -> None:
+        """Callback for m.room.power_levels events. Keeps the power levels cache up
+        to date, so we don't have to fetch them from the homeserver on every join.
+
+        Args:
+            room: The room the event was sent in.
+
+            event: The power levels event.
+        """
+        self._pl_cache[room.room_id] = event.source.get("content", {})
+
+    def _update_power_levels_from_state(
+        self, room_id: str, room_info: RoomInfo
+    ) -> None:
+        """nio only runs event callbacks for timeline events, so power level changes
+        in the state block of a sync never reach `callbacks.power_levels`. Pick
+        them up here so the cache doesn't go stale.
+
+        Args:
+            room_id: The ID of the room.
+
+            room_info: The sync response section of the room.
+        """
+        if any(isinstance(e, PowerLevelsEvent) for e in room_info.timeline.events):
+            # Newer than anything in the state block, already cached
+            return
+        for event in reversed(room_info.state):
+            if isinstance(event, PowerLevelsEvent):
+                self._pl_cache[room_id] = event.source.get("content", {})
+                return
+        if room_info.timeline.limited:
+            # We missed part of the timeline, fetch the power levels again
+            self._pl_cache.pop(room_id, None)
 
     async def invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Callback for when an invite is received. Join the room specified in the invite.
@@ -47,14 +136,15 @@ class Callbacks:
 
             event: The invite event.
         """
-        logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
+        logger.debug("Got invite to %s from %s.", room.room_id, event.sender)
 
         # Attempt to join 3 times before giving up
         for attempt in range(3):
             result = await self.client.join(room.room_id)
-            if type(result) == JoinError:
+            if isinstance(result, JoinError):
                 logger.error(
-                    f"Error joining room {room.room_id} (attempt %d): %s",
+                    "Error joining room %s (attempt %d): %s",
+                    room.room_id,
                     attempt,
                     result.message,
                 )
@@ -64,7 +154,7 @@ class Callbacks:
             logger.error("Unable to join room: %s", room.room_id)
 
         # Successfully joined room
-        logger.info(f"Joined {room.room_id}")
+        logger.info("Joined %s", room.room_id)
 
     async def invite_event_filtered_callback(
         self, room: MatrixRoom, event: InviteMemberEvent
@@ -91,7 +181,18 @@ class Callbacks:
 
             reacted_to_id: The event ID that the reaction points to.
         """
-        logger.debug(f"Got reaction to {room.room_id} from {event.sender}.")
+        logger.debug("Got reaction to %s from %s.", room.room_id, event.sender)
+
+        # Only the restricted user can confirm their own join. If we already know
+        # the sender has no power level override, there is nothing left to do.
+        power_levels = self._pl_cache.get(room.room_id)
+        if power_levels is not None and event.sender not in power_levels.get(
+            "users", EMPTY
+        ):
+            logger.debug(
+                "%s has no power level override in %s.", event.sender, room.room_id
+            )
+            return
 
         # Get the original event that was reacted to
         event_response = await self.client.room_get_event(room.room_id, reacted_to_id)
@@ -101,36 +202,57 @@ class Callbacks:
             )
             return
         reacted_to_event = event_response.event
-        if (
-            is_bot_event(reacted_to_event)
-            and get_bot_event_type(reacted_to_event) == "join_confirm"
-        ):
+        if get_bot_event_type(reacted_to_event) == "join_confirm":
             content = reacted_to_event.source.get("content")
-            state_key = content.get("io.github.shadowrz.jose_bot", {}).get("state_key")
-            required_reaction = hash_user_id(state_key)
+            bot_data = content.get(BOT_NAMESPACE, EMPTY)
+            state_key = bot_data.get("state_key")
+            required_reaction = bot_data.get("required_reaction")
+            if not required_reaction:
+                # Sent by an older version, which picked the reaction with a hash
+                # we can no longer reproduce.
+                logger.warning(
+                    "Join confirmation %s has no required reaction, can't verify it.",
+                    reacted_to_event.event_id,
+                )
+                return
 
-            reaction_content = (
-                event.source.get("content", {}).get("m.relates_to", {}).get("key")
-            )
+            try:
+                reaction_content = event.source["content"]["m.relates_to"]["key"]
+            except (KeyError, TypeError):
+                reaction_content = None
 
             if reaction_content == required_reaction and event.sender == state_key:
-                state_resp = await self.client.room_get_state_event(
-                    room.room_id, "m.room.power_levels"
-                )
-                if isinstance(state_resp, RoomGetStateEventError):
-                    logger.warn(
-                        f"Failed to get power level data in room {room.display_name} ({room.room_id}). Stop processing."
+                async with self._power_levels_lock(room.room_id):
+                    power_levels = await self._get_power_levels(room)
+                    if power_levels is None:
+                        return
+                    if state_key not in power_levels.get("users", EMPTY):
+                        # Nothing to lift, don't send a no-op state event
+                        logger.debug(
+                            "%s has no power level override in %s.",
+                            state_key,
+                            room.room_id,
+                        )
+                        return
+                    # m.room.power_levels has no partial updates, send back the
+                    # whole content we got. Work on a copy, the cache must only
+                    # hold what the homeserver accepted.
+                    users = dict(power_levels["users"])
+                    users.pop(state_key, None)
+                    content = dict(power_levels, users=users)
+                    put_state_resp = await self.client.room_put_state(
+                        room.room_id,
+                        "m.room.power_levels",
+                        content,
                     )
-                    return
-                content = state_resp.content
-                events = content.get("events")
-                users = content.get("users")
-                del users[state_key]
-                await self.client.room_put_state(
-                    room.room_id,
-                    "m.room.power_levels",
-                    {"events": events, "users": users},
-                )
+                    if isinstance(put_state_resp, RoomPutStateError):
+                        logger.warn(
+                            "Failed to reconfigure power level: %s",
+                            put_state_resp.message,
+                        )
+                        self._pl_cache.pop(room.room_id, None)
+                        return
+                    self._pl_cache[room.room_id] = content
                 await self.client.room_redact(
                     room.room_id,
                     reacted_to_event.event_id,
@@ -149,16 +271,73 @@ class Callbacks:
         """
         if event.type == "m.reaction":
             # Get the ID of the event this was a reaction to
-            relation_dict = event.source.get("content", {}).get("m.relates_to", {})
+            try:
+                relation_dict = event.source["content"]["m.relates_to"]
+            except (KeyError, TypeError):
+                relation_dict = EMPTY
 
             reacted_to = relation_dict.get("event_id")
             if reacted_to and relation_dict.get("rel_type") == "m.annotation":
                 await self._reaction(room, event, reacted_to)
-                return
+
+    def unknown_event_filtered_callback(
+        self, room: MatrixRoom, event: UnknownEvent
+    ) -> Optional[Awaitable[None]]:
+        """
+        Most UnknownEvents we receive are custom event types we don't care about.
+        This is a plain function so those are dropped without creating a coroutine,
+        and only reactions are passed on to `callbacks.unknown` (nio awaits the
+        returned coroutine).
+        """
+        if event.type == "m.reaction":
+            return self.unknown(room, event)
 
         logger.debug(
-            f"Got unknown event with type to {event.type} from {event.sender} in {room.room_id}."
+            "Got unknown event with type %s from %s in %s.",
+            event.type,
+            event.sender,
+            room.room_id,
         )
+        return None
+
+    async def sync(self, response: SyncResponse) -> None:
+        """Callback for every sync response. Handles the membership events of all
+        joined rooms concurrently, so a burst of joins doesn't wait on each other's
+        requests. Power level updates within a room still happen one at a time.
+
+        Args:
+            response: The sync response.
+        """
+        # Only the last membership change of a user matters, so someone flapping
+        # within one sync is handled once. A join following a join is a profile
+        # change and doesn't replace the actual join. prev_membership can't tell
+        # us that, as it's missing when the homeserver leaves out prev_content.
+        latest: Dict[Tuple[str, str], Tuple[MatrixRoom, RoomMemberEvent]] = {}
+        for room_id, room_info in response.rooms.join.items():
+            self._update_power_levels_from_state(room_id, room_info)
+            room = self.client.rooms[room_id]
+            for event in room_info.timeline.events:
+                if not isinstance(event, RoomMemberEvent):
+                    continue
+                key = (room_id, event.state_key)
+                if (
+                    event.membership == "join"
+                    and key in latest
+                    and latest[key][1].membership == "join"
+                ):
+                    continue
+                latest[key] = (room, event)
+
+        results = await asyncio.gather(
+            *(self.membership(room, event) for room, event in latest.values()),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(
+                    "Error handling membership event.",
+                    exc_info=(type(result), result, result.__traceback__),
+                )
 
     async def membership(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
         if event.membership in ("leave", "ban", "invite"):
@@ -168,46 +347,58 @@ class Callbacks:
             "invite",
             "leave",
         ):
-            content = event.content or {}
+            content = event.content or EMPTY
             name = content.get("displayname")
             logger.info(
-                f"New user joined in {room.display_name}: {name} ({event.state_key})"
+                "New user joined in %s: %s (%s)",
+                room.display_name,
+                name,
+                event.state_key,
             )
             _, domain = get_user_id_parts(event.state_key)
             if domain in self.config.allowed_servers:
                 logger.info(
-                    f"{name} ({event.state_key}) is in allowed servers. Stop processing."
+                    "%s (%s) is in allowed servers. Stop processing.",
+                    name,
+                    event.state_key,
                 )
                 return
             if self.config.dry_run:
                 return
-            state_resp = await self.client.room_get_state_event(
-                room.room_id, "m.room.power_levels"
-            )
-            if isinstance(state_resp, RoomGetStateEventError):
-                logger.warn(
-                    f"Failed to get power level data in room {room.display_name} ({room.room_id}). Stop processing."
-                )
-                return
-            content = state_resp.content
-            events = content.get("events")
-            events["m.reaction"] = -1
-            users = content.get("users")
-            powers = PowerLevels(events=events, users=users)
-            if not powers.can_user_send_state(self.client.user, "m.room.power_levels"):
-                logger.warn(
-                    f"Bot is unable to update power levels in {room.display_name} ({room.room_id}). Stop processing."
-                )
-                return
-            users[event.state_key] = -1
-            put_state_resp = await self.client.room_put_state(
-                room.room_id, "m.room.power_levels", {"events": events, "users": users}
-            )
-            if isinstance(put_state_resp, RoomPutStateError):
-                logger.warn(
-                    f"Failed to reconfigure power level: {put_state_resp.message}"
+            # Joins in the same room are handled concurrently, don't let them
+            # overwrite each other's power level changes.
+            async with self._power_levels_lock(room.room_id):
+                power_levels = await self._get_power_levels(room)
+                if power_levels is None:
+                    return
+                # Work on a copy, the cache must only hold what the homeserver
+                # accepted.
+                events = dict(power_levels.get("events", EMPTY))
+                events["m.reaction"] = -1
+                users = dict(power_levels.get("users", EMPTY))
+                powers = PowerLevels(events=events, users=users)
+                if not powers.can_user_send_state(
+                    self.client.user, "m.room.power_levels"
+                ):
+                    logger.warn(
+                        "Bot is unable to update power levels in %s (%s). Stop processing.",
+                        room.display_name,
+                        room.room_id,
+                    )
+                    return
+                users[event.state_key] = -1
+                content = dict(power_levels, events=events, users=users)
+                put_state_resp = await self.client.room_put_state(
+                    room.room_id, "m.room.power_levels", content
                 )
-                return
+                if isinstance(put_state_resp, RoomPutStateError):
+                    logger.warn(
+                        "Failed to reconfigure power level: %s", put_state_resp.message
+                    )
+                    self._pl_cache.pop(room.room_id, None)
+                    return
+                self._pl_cache[room.room_id] = content
+            required_reaction = hash_user_id(event.state_key)
             await send_text_to_room(
                 self.client,
                 room.room_id,
@@ -217,8 +408,12 @@ Newly joined {0} ({1}), please react to this message with {2}\
 """.format(
                     user_name(room, event.state_key),
                     event.state_key,
-                    hash_user_id(event.state_key),
+                    required_reaction,
                 ),
                 notice=True,
-                extended_data={"type": "join_confirm", "state_key": event.state_key},
+                extended_data={
+                    "type": "join_confirm",
+                    "state_key": event.state_key,
+                    "required_reaction": required_reaction,
+                },
             )
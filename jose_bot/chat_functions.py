@@ -3,6 +3,8 @@ from typing import Any, Dict, Optional, Union
 
 from nio import AsyncClient, ErrorResponse, RoomSendResponse, SendRetryError
 
+from jose_bot.utils import BOT_NAMESPACE
+
 logger = logging.getLogger(__name__)
 
 
@@ -32,26 +34,29 @@ async def send_text_to_room(
         reply_to_event_id: Whether this message is a reply to another event. The event
             ID this is message is a reply to.
 
+        extended_data: Custom data attached to the message for tracking it later.
+            A "type" key sets the bot message type, defaulting to "text".
+
     Returns:
         A RoomSendResponse if the request was successful, else an ErrorResponse.
     """
-    # Determine whether to ping room members or not
-    msgtype = "m.notice" if notice else "m.text"
-
+    extended_data = extended_data or {}
     content = {
-        "msgtype": msgtype,
+        # Determine whether to ping room members or not
+        "msgtype": "m.notice" if notice else "m.text",
         "body": message,
+        # Add custom data for tracking bot message. This is a copy, so the
+        # caller's extended_data is left untouched.
+        BOT_NAMESPACE: {
+            **extended_data,
+            "in_reply_to": reply_to_event_id,
+            "type": extended_data.get("type") or "text",
+        },
     }
 
     if reply_to_event_id:
         content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
-    # Add custom data for tracking bot message.
-    content["io.github.shadowrz.jose_bot"] = extended_data or {}
-    content["io.github.shadowrz.jose_bot"]["in_reply_to"] = reply_to_event_id
-    if not content["io.github.shadowrz.jose_bot"].get("type"):
-        content["io.github.shadowrz.jose_bot"]["type"] = "text"
-
     try:
         return await client.room_send(
             room_id,
@@ -60,4 +65,4 @@ async def send_text_to_room(
             ignore_unverified_devices=True,
         )
     except SendRetryError:
-        logger.exception(f"Unable to send message response to {room_id}")
+        logger.exception("Unable to send message response to %s", room_id)
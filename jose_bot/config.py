@@ -84,12 +84,12 @@ class Config:
             ["matrix", "device_name"], default="nio-template"
         )
         self.homeserver_url = self._get_cfg(["matrix", "homeserver_url"], required=True)
-        self.allowed_servers = self._get_cfg(
-            ["allowed_servers"], default=[], required=False
-        )
+        allowed_servers = self._get_cfg(["allowed_servers"], default=[], required=False)
         self.dry_run = self._get_cfg(["dry_run"], required=False, default=False)
-        if not isinstance(self.allowed_servers, list):
+        if not isinstance(allowed_servers, list):
             raise ConfigError("allowed_servers must be an array of strings")
+        # Checked on every join, so make lookups O(1)
+        self.allowed_servers = frozenset(allowed_servers)
 
     def _get_cfg(
         self,
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
 import sys
-from time import sleep
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
@@ -10,8 +10,9 @@ from nio import (
     InviteMemberEvent,
     LocalProtocolError,
     LoginError,
-    RoomMemberEvent,
+    PowerLevelsEvent,
     SyncError,
+    SyncResponse,
     UnknownEvent,
 )
 
@@ -21,6 +22,40 @@ from jose_bot.config import Config
 logger = logging.getLogger(__name__)
 
 
+async def initial_sync(
+    client: AsyncClient, callbacks: Callbacks, catch_up: bool
+) -> SyncResponse:
+    """Sync with the homeserver, retrying until it succeeds.
+
+    Args:
+        client: The client to sync with.
+
+        callbacks: The bot callbacks.
+
+        catch_up: Whether to handle the events in the response. After a reconnect
+            the sync continues from where we left off and holds events we haven't
+            seen yet. nio only runs response callbacks in sync_forever, so they
+            have to be handed to `callbacks.sync` here.
+
+    Returns:
+        The sync response.
+    """
+    # Power levels may have changed while we were disconnected. Don't rely on
+    # them showing up in the sync response, or we would write stale ones back.
+    callbacks.clear_power_levels_cache()
+
+    resp = await client.sync(timeout=30000, full_state=True)
+    while isinstance(resp, SyncError):
+        logger.warning("Initial sync failed, retrying in 30s...")
+        await asyncio.sleep(30)
+        resp = await client.sync(timeout=30000, full_state=True)
+    logger.info("Initial sync completed.")
+
+    if catch_up:
+        await callbacks.sync(resp)
+    return resp
+
+
 async def main():
     """The first function that is run when starting the bot"""
 
@@ -73,7 +108,7 @@ async def main():
                     )
 
                     # Check if login failed
-                    if type(login_response) == LoginError:
+                    if isinstance(login_response, LoginError):
                         logger.error("Failed to login: %s", login_response.message)
                         return False
                 except LocalProtocolError as e:
@@ -89,15 +124,10 @@ async def main():
 
                 # Login succeeded!
 
-            logger.info(f"Logged in as {config.user_id}")
+            logger.info("Logged in as %s", config.user_id)
 
-            # Do a initial sync
-            resp = await client.sync(timeout=30000, full_state=True)
-            while isinstance(resp, SyncError):
-                logger.warning("Initial sync failed, retrying in 30s...")
-                sleep(30)
-                resp = await client.sync(timeout=30000, full_state=True)
-            logger.info("Initial sync completed.")
+            # Do a initial sync. When reconnecting, handle the events we missed.
+            resp = await initial_sync(client, callbacks, catch_up=callbacks_added)
             sync_token = resp.next_batch
 
             if not callbacks_added:
@@ -105,22 +135,25 @@ async def main():
                 client.add_event_callback(
                     callbacks.invite_event_filtered_callback, (InviteMemberEvent,)
                 )
-                client.add_event_callback(callbacks.membership, (RoomMemberEvent,))
-                client.add_event_callback(callbacks.unknown, (UnknownEvent,))
+                client.add_event_callback(callbacks.power_levels, (PowerLevelsEvent,))
+                client.add_response_callback(callbacks.sync, (SyncResponse,))
+                client.add_event_callback(
+                    callbacks.unknown_event_filtered_callback, (UnknownEvent,)
+                )
 
                 callbacks_added = True
 
-            await client.sync_forever(timeout=30000, full_state=True, since=sync_token)
+            await client.sync_forever(timeout=30000, since=sync_token)
 
         except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
             logger.warning("Unable to connect to homeserver, retrying in 15s...")
 
             # Sleep so we don't bombard the server with login requests
-            sleep(15)
+            await asyncio.sleep(15)
         except Exception:
             logger.exception("An exception was raised.")
             # Sleep so we don't bombard the server with login requests
-            sleep(15)
+            await asyncio.sleep(15)
         finally:
             # Make sure to close the client connection on disconnect
             await client.close()
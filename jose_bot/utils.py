@@ -1,29 +1,30 @@
-import re
-from typing import Optional, Tuple
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Mapping, Optional, Tuple
 
-import xxhash
 from nio import Event, MatrixRoom
 
-REACTIONS = ["🎉", "🤣", "😃", "😋", "🥳", "🤔", "😅"]
+# Key of the custom data the bot attaches to its own messages
+BOT_NAMESPACE = "io.github.shadowrz.jose_bot"
 
+# Shared read-only default for lookups into event content
+EMPTY: Mapping[str, Any] = MappingProxyType({})
 
-def hash_user_id(user_id: str):
-    hash = xxhash.xxh64_intdigest(user_id)
-    return REACTIONS[hash % len(REACTIONS)]
+REACTIONS = ("🎉", "🤣", "😃", "😋", "🥳", "🤔", "😅")
+_N = len(REACTIONS)
 
 
-def get_bot_event_type(event: Event) -> Optional[str]:
-    if is_bot_event(event):
-        content = event.source.get("content")
-        type = content.get("io.github.shadowrz.jose_bot", {}).get("type")
-        return type
-    else:
-        return None
+@lru_cache(maxsize=4096)
+def hash_user_id(user_id: str) -> str:
+    # str hashes are salted per process, which is all we need: the reaction only
+    # has to stay stable while the bot waits for the user to react.
+    return REACTIONS[hash(user_id) % _N]
 
 
-def is_bot_event(event: Event) -> bool:
-    content = event.source.get("content")
-    return "io.github.shadowrz.jose_bot" in content
+def get_bot_event_type(event: Event) -> Optional[str]:
+    content = event.source.get("content") or EMPTY
+    bot_data = content.get(BOT_NAMESPACE)
+    return bot_data.get("type") if bot_data else None
 
 
 def user_name(room: MatrixRoom, user_id: str) -> Optional[str]:
@@ -34,18 +35,15 @@ def user_name(room: MatrixRoom, user_id: str) -> Optional[str]:
     return user.name
 
 
-# A structure for a Matrix UID. It also supports legacy UID formats.
-# First part: [\!-9\;-\~]+
-# Matches legacy UIDs too.
-# Second part:
-# // IPv4 Address: [0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}
-# // IPv6 Address: \[[0-9A-Fa-f:.]{2,45}\]
-# // DNS name: [-.0-9A-Za-z]{1,255}
-# // Port: [0-9]{1,5}
-# // Hostname: [0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}|\[[0-9A-Fa-f:.]{2,45}\]|[-.0-9A-Za-z]{1,255}(?::[0-9]{1,5})?
-MATRIX_UID_RE = r"@([\!-9\;-\~]+):([0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}|\[[0-9A-Fa-f:.]{2,45}\]|[-.0-9A-Za-z]{1,255}(?::[0-9]{1,5})?)"
-
-
 def get_user_id_parts(user_id: str) -> Tuple[str, str]:
-    uid, domain = re.match(MATRIX_UID_RE, user_id).groups()
-    return (uid, domain)
+    """Split a user ID into its localpart and server name. The server name keeps
+    its port, if any.
+
+    Raises:
+        ValueError: If user_id isn't in the form @localpart:domain.
+    """
+    if user_id.startswith("@"):
+        localpart, sep, domain = user_id[1:].partition(":")
+        if localpart and sep and domain:
+            return (localpart, domain)
+    raise ValueError(f"Invalid user ID: {user_id}")
@@ -1,9 +1,13 @@
+import asyncio
+import copy
+import inspect
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import nio
 
 from jose_bot.callbacks import Callbacks
+from jose_bot.utils import BOT_NAMESPACE
 
 from tests.utils import make_awaitable, run_coroutine
 
@@ -13,12 +17,67 @@ class CallbacksTestCase(unittest.TestCase):
         # Create a Callbacks object and give it some Mock'd objects to use
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
+        # Python 3.8+ would give us AsyncMocks here, but 3.7 doesn't, so explicitly
+        # return awaitables from the client requests the tests need
+        self.fake_client.room_send = Mock(return_value=make_awaitable(None))
+        self.fake_client.room_redact = Mock(return_value=make_awaitable(None))
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
+        self.fake_config.allowed_servers = frozenset()
+        self.fake_config.dry_run = False
 
         self.callbacks = Callbacks(self.fake_client, self.fake_config)
 
+    def _make_room(self) -> Mock:
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.display_name = "Fake room"
+        fake_room.users = {}
+        self.fake_client.rooms = {fake_room.room_id: fake_room}
+        return fake_room
+
+    def _make_member_event(
+        self, user_id: str, membership: str, prev_membership: str = None
+    ) -> Mock:
+        fake_member_event = Mock(spec=nio.RoomMemberEvent)
+        fake_member_event.state_key = user_id
+        fake_member_event.membership = membership
+        fake_member_event.prev_membership = prev_membership
+        fake_member_event.content = {"membership": membership}
+        return fake_member_event
+
+    def _make_sync_response(
+        self, room: Mock, events: list, state: list = (), limited: bool = False
+    ) -> Mock:
+        fake_room_info = Mock()
+        fake_room_info.timeline.events = events
+        fake_room_info.timeline.limited = limited
+        fake_room_info.state = list(state)
+
+        fake_response = Mock()
+        fake_response.rooms.join = {room.room_id: fake_room_info}
+        return fake_response
+
+    def _serve_power_levels(self, content: dict) -> None:
+        """Pretend that the homeserver holds the given power levels content"""
+        self.server_power_levels = content
+
+        async def room_get_state_event(room_id, event_type):
+            # Yield to other tasks, like a real request would
+            await asyncio.sleep(0)
+            return nio.RoomGetStateEventResponse(
+                copy.deepcopy(self.server_power_levels), event_type, "", room_id
+            )
+
+        async def room_put_state(room_id, event_type, content):
+            await asyncio.sleep(0)
+            self.server_power_levels = copy.deepcopy(content)
+            return nio.RoomPutStateResponse("$fake_event", room_id)
+
+        self.fake_client.room_get_state_event = Mock(side_effect=room_get_state_event)
+        self.fake_client.room_put_state = Mock(side_effect=room_put_state)
+
     def test_invite(self):
         """Tests the callback for InviteMemberEvents"""
         # Tests that the bot attempts to join a room after being invited to it
@@ -40,6 +99,248 @@ class CallbacksTestCase(unittest.TestCase):
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    def test_sync_concurrent_joins(self):
+        """Tests that joins in the same room don't drop each other's restrictions"""
+        fake_room = self._make_room()
+        self._serve_power_levels({"users": {"@fake_user:example.com": 100}})
+
+        # Two users join the room in the same sync
+        fake_response = self._make_sync_response(
+            fake_room,
+            [
+                self._make_member_event("@a:evil.org", "join"),
+                self._make_member_event("@b:evil.org", "join"),
+            ],
+        )
+        run_coroutine(self.callbacks.sync(fake_response))
+
+        # Check that both users got restricted
+        self.assertEqual(
+            self.server_power_levels["users"],
+            {"@fake_user:example.com": 100, "@a:evil.org": -1, "@b:evil.org": -1},
+        )
+
+    def _sync_membership_calls(self, events: list) -> list:
+        """Run a sync with the given events, returning the events passed on to
+        `membership`
+        """
+        fake_room = self._make_room()
+        fake_response = self._make_sync_response(fake_room, events)
+        membership = Mock(return_value=make_awaitable(None))
+        with patch.object(Callbacks, "membership", membership):
+            run_coroutine(self.callbacks.sync(fake_response))
+        return [args[1] for args, _ in membership.call_args_list]
+
+    def test_sync_join_leave_join(self):
+        """Tests that a user rejoining within one sync is handled once"""
+        events = [
+            self._make_member_event("@a:evil.org", "join"),
+            self._make_member_event("@a:evil.org", "leave", "join"),
+            self._make_member_event("@a:evil.org", "join", "leave"),
+        ]
+        self.assertEqual(self._sync_membership_calls(events), [events[2]])
+
+    def test_sync_join_leave(self):
+        """Tests that a user leaving right after joining is only handled as leaving"""
+        events = [
+            self._make_member_event("@a:evil.org", "join"),
+            self._make_member_event("@a:evil.org", "leave", "join"),
+        ]
+        self.assertEqual(self._sync_membership_calls(events), [events[1]])
+
+    def test_sync_join_profile_change(self):
+        """Tests that a profile change doesn't replace the join it follows"""
+        events = [
+            self._make_member_event("@a:evil.org", "join", "invite"),
+            self._make_member_event("@a:evil.org", "join", "join"),
+            # prev_membership is None when prev_content is missing
+            self._make_member_event("@a:evil.org", "join", None),
+        ]
+        self.assertEqual(self._sync_membership_calls(events), [events[0]])
+
+    def test_sync_power_levels_state(self):
+        """Tests that power levels in the state block of a sync update the cache"""
+        fake_room = self._make_room()
+        self.callbacks._pl_cache[fake_room.room_id] = {"users": {}}
+
+        fake_power_levels_event = Mock(spec=nio.PowerLevelsEvent)
+        fake_power_levels_event.source = {
+            "content": {"users": {"@admin:example.com": 100}}
+        }
+        fake_response = self._make_sync_response(
+            fake_room, [], state=[fake_power_levels_event], limited=True
+        )
+        run_coroutine(self.callbacks.sync(fake_response))
+
+        self.assertEqual(
+            self.callbacks._pl_cache[fake_room.room_id],
+            {"users": {"@admin:example.com": 100}},
+        )
+
+    def test_sync_limited(self):
+        """Tests that a limited sync drops the cached power levels of the room"""
+        fake_room = self._make_room()
+        self.callbacks._pl_cache[fake_room.room_id] = {"users": {}}
+
+        fake_response = self._make_sync_response(fake_room, [], limited=True)
+        run_coroutine(self.callbacks.sync(fake_response))
+
+        self.assertNotIn(fake_room.room_id, self.callbacks._pl_cache)
+
+    def test_membership_power_levels_cache_miss(self):
+        """Tests that power levels are fetched and cached when they aren't cached yet"""
+        fake_room = self._make_room()
+        self._serve_power_levels({"users": {"@fake_user:example.com": 100}})
+
+        fake_member_event = self._make_member_event("@a:evil.org", "join")
+        run_coroutine(self.callbacks.membership(fake_room, fake_member_event))
+
+        self.fake_client.room_get_state_event.assert_called_once_with(
+            fake_room.room_id, "m.room.power_levels"
+        )
+        # The cache holds what was sent to the homeserver
+        self.assertEqual(
+            self.callbacks._pl_cache[fake_room.room_id], self.server_power_levels
+        )
+
+    def test_membership_power_levels_cache_hit(self):
+        """Tests that cached power levels are used without asking the homeserver"""
+        fake_room = self._make_room()
+        self._serve_power_levels({})
+        self.callbacks._pl_cache[fake_room.room_id] = {
+            "users": {"@fake_user:example.com": 100}
+        }
+
+        fake_member_event = self._make_member_event("@a:evil.org", "join")
+        run_coroutine(self.callbacks.membership(fake_room, fake_member_event))
+
+        self.fake_client.room_get_state_event.assert_not_called()
+        self.assertEqual(
+            self.server_power_levels,
+            {
+                "events": {"m.reaction": -1},
+                "users": {"@fake_user:example.com": 100, "@a:evil.org": -1},
+            },
+        )
+
+    def test_membership_power_levels_put_error(self):
+        """Tests that the cached power levels are dropped when updating them fails"""
+        fake_room = self._make_room()
+        self.callbacks._pl_cache[fake_room.room_id] = {
+            "users": {"@fake_user:example.com": 100}
+        }
+        self.fake_client.room_put_state = Mock(
+            return_value=make_awaitable(nio.RoomPutStateError("Forbidden"))
+        )
+
+        fake_member_event = self._make_member_event("@a:evil.org", "join")
+        run_coroutine(self.callbacks.membership(fake_room, fake_member_event))
+
+        self.assertNotIn(fake_room.room_id, self.callbacks._pl_cache)
+        self.fake_client.room_send.assert_not_called()
+
+    def test_membership_power_levels_no_permission(self):
+        """Tests that the cache is left alone when the bot can't change power levels"""
+        fake_room = self._make_room()
+        cached = {
+            "users": {"@fake_user:example.com": 50},
+            "events": {"m.room.power_levels": 100},
+        }
+        self.callbacks._pl_cache[fake_room.room_id] = copy.deepcopy(cached)
+
+        fake_member_event = self._make_member_event("@a:evil.org", "join")
+        run_coroutine(self.callbacks.membership(fake_room, fake_member_event))
+
+        self.fake_client.room_put_state.assert_not_called()
+        self.assertEqual(self.callbacks._pl_cache[fake_room.room_id], cached)
+
+    def _react(self, reaction_content: dict, bot_data: dict) -> None:
+        """Pretend that a restricted user reacted to a join confirmation"""
+        fake_room = self._make_room()
+        self.callbacks._pl_cache[fake_room.room_id] = {
+            "users": {"@fake_user:example.com": 100, "@a:evil.org": -1}
+        }
+        self._serve_power_levels({})
+
+        fake_confirm_event = Mock(spec=nio.RoomMessageNotice)
+        fake_confirm_event.event_id = "$confirm"
+        fake_confirm_event.source = {"content": {BOT_NAMESPACE: bot_data}}
+        fake_event_response = Mock(spec=nio.RoomGetEventResponse)
+        fake_event_response.event = fake_confirm_event
+        self.fake_client.room_get_event = Mock(
+            return_value=make_awaitable(fake_event_response)
+        )
+
+        fake_reaction_event = Mock(spec=nio.UnknownEvent)
+        fake_reaction_event.sender = "@a:evil.org"
+        fake_reaction_event.source = {"content": {"m.relates_to": reaction_content}}
+        run_coroutine(
+            self.callbacks._reaction(fake_room, fake_reaction_event, "$confirm")
+        )
+
+    def test_reaction(self):
+        """Tests that the right reaction lifts the restriction"""
+        self._react(
+            {"event_id": "$confirm", "rel_type": "m.annotation", "key": "🎉"},
+            {
+                "type": "join_confirm",
+                "state_key": "@a:evil.org",
+                "required_reaction": "🎉",
+            },
+        )
+
+        self.assertEqual(
+            self.server_power_levels, {"users": {"@fake_user:example.com": 100}}
+        )
+        self.fake_client.room_redact.assert_called_once()
+
+    def test_reaction_without_key(self):
+        """Tests that confirmations without a required reaction are never accepted"""
+        self._react(
+            {"event_id": "$confirm", "rel_type": "m.annotation"},
+            {"type": "join_confirm", "state_key": "@a:evil.org"},
+        )
+
+        self.fake_client.room_put_state.assert_not_called()
+        self.fake_client.room_redact.assert_not_called()
+
+    def test_unknown_event_filtered_callback(self):
+        """Tests that only reactions are passed on to be handled"""
+        fake_room = self._make_room()
+        fake_reaction_event = Mock(spec=nio.UnknownEvent)
+        fake_reaction_event.type = "m.reaction"
+        fake_reaction_event.source = {
+            "content": {
+                "m.relates_to": {
+                    "event_id": "$confirm",
+                    "rel_type": "m.annotation",
+                    "key": "🎉",
+                }
+            }
+        }
+        fake_custom_event = Mock(spec=nio.UnknownEvent)
+        fake_custom_event.type = "org.example.custom"
+        fake_custom_event.sender = "@a:evil.org"
+
+        reaction = Mock(return_value=make_awaitable(None))
+        with patch.object(Callbacks, "_reaction", reaction):
+            # Other event types are dropped without anything to await
+            self.assertIsNone(
+                self.callbacks.unknown_event_filtered_callback(
+                    fake_room, fake_custom_event
+                )
+            )
+
+            # Reactions give an awaitable that nio awaits, which handles the reaction
+            result = self.callbacks.unknown_event_filtered_callback(
+                fake_room, fake_reaction_event
+            )
+            self.assertTrue(inspect.isawaitable(result))
+            reaction.assert_not_called()
+            run_coroutine(result)
+
+        reaction.assert_called_once_with(fake_room, fake_reaction_event, "$confirm")
+
 
 if __name__ == "__main__":
     unittest.main()
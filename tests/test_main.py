@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import nio
+
+from jose_bot.callbacks import Callbacks
+from jose_bot.main import initial_sync
+
+from tests.utils import make_awaitable, run_coroutine
+
+
+class MainTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user = "@fake_user:example.com"
+
+        self.fake_room = Mock(spec=nio.MatrixRoom)
+        self.fake_room.room_id = "!abcdefg:example.com"
+        self.fake_client.rooms = {self.fake_room.room_id: self.fake_room}
+
+        self.callbacks = Callbacks(self.fake_client, Mock())
+
+        self.fake_member_event = Mock(spec=nio.RoomMemberEvent)
+        self.fake_member_event.state_key = "@a:evil.org"
+        self.fake_member_event.membership = "join"
+        self.fake_member_event.prev_membership = None
+
+    def _sync_with_join(self, catch_up: bool, state: list = ()) -> Mock:
+        """Run initial_sync on a sync response holding a join, returning the
+        mocked `membership` callback
+        """
+        fake_room_info = Mock()
+        fake_room_info.timeline.events = [self.fake_member_event]
+        fake_room_info.timeline.limited = False
+        fake_room_info.state = list(state)
+        fake_response = Mock()
+        fake_response.rooms.join = {self.fake_room.room_id: fake_room_info}
+        self.fake_client.sync = Mock(return_value=make_awaitable(fake_response))
+
+        membership = Mock(return_value=make_awaitable(None))
+        with patch.object(Callbacks, "membership", membership):
+            resp = run_coroutine(
+                initial_sync(self.fake_client, self.callbacks, catch_up)
+            )
+        self.assertIs(resp, fake_response)
+        return membership
+
+    def test_initial_sync_reconnect(self):
+        """Tests that joins in the sync after a reconnect are handled"""
+        membership = self._sync_with_join(catch_up=True)
+
+        membership.assert_called_once_with(self.fake_room, self.fake_member_event)
+
+    def test_initial_sync_startup(self):
+        """Tests that the events of the very first sync are left alone"""
+        membership = self._sync_with_join(catch_up=False)
+
+        membership.assert_not_called()
+
+    def test_initial_sync_clears_power_levels(self):
+        """Tests that power levels cached before a reconnect are forgotten"""
+        self.callbacks._pl_cache[self.fake_room.room_id] = {"users": {}}
+
+        self._sync_with_join(catch_up=True)
+
+        self.assertEqual(self.callbacks._pl_cache, {})
+
+    def test_initial_sync_power_levels_state(self):
+        """Tests that power levels in the state of the reconnect sync are cached"""
+        self.callbacks._pl_cache[self.fake_room.room_id] = {"users": {}}
+        fake_power_levels_event = Mock(spec=nio.PowerLevelsEvent)
+        fake_power_levels_event.source = {
+            "content": {"users": {"@admin:example.com": 100}}
+        }
+
+        self._sync_with_join(catch_up=True, state=[fake_power_levels_event])
+
+        self.assertEqual(
+            self.callbacks._pl_cache,
+            {self.fake_room.room_id: {"users": {"@admin:example.com": 100}}},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
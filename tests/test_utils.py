@@ -0,0 +1,34 @@
+import unittest
+
+from jose_bot.utils import get_user_id_parts
+
+
+class UtilsTestCase(unittest.TestCase):
+    def test_get_user_id_parts(self):
+        """Test that get_user_id_parts splits user IDs correctly"""
+        self.assertEqual(
+            get_user_id_parts("@alice:example.com"), ("alice", "example.com")
+        )
+
+        # Ports are part of the server name
+        self.assertEqual(
+            get_user_id_parts("@alice:example.com:8448"),
+            ("alice", "example.com:8448"),
+        )
+
+        # IP literals keep their port too
+        self.assertEqual(
+            get_user_id_parts("@alice:1.2.3.4:8448"), ("alice", "1.2.3.4:8448")
+        )
+        self.assertEqual(
+            get_user_id_parts("@alice:[::1]:8448"), ("alice", "[::1]:8448")
+        )
+
+        # Anything that isn't @localpart:domain is rejected
+        for user_id in ("alice:example.com", "@alice", "@:example.com", "@alice:"):
+            with self.assertRaises(ValueError):
+                get_user_id_parts(user_id)
+
+
+if __name__ == "__main__":
+    unittest.main()